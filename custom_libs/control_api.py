@@ -0,0 +1,348 @@
+# coding=UTF-8
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from PyQt5 import QtCore
+
+from custom_libs.schleichore import TestManager, TestReport
+
+
+class ControlRequestHandler(BaseHTTPRequestHandler):
+    """ Routes the requests of the local control API
+
+    GET  /state                       Current state of the station
+    POST /start                       Asks for a test, as if the Start Test button was pressed, /events confirms it
+    GET  /events                      Server-sent events for every feedback change and downloaded report
+    GET  /reports                     Reports in the backup folder, newest first, ?offset=0&limit=<history>
+    GET  /reports/<id|latest>         A report, ?format=json (default), raw or xlsx
+    """
+
+    CONTENT_TYPES = {
+        'json': 'application/json',
+        'raw': 'text/plain; charset=utf-8',
+        'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    }
+
+    def log_message(self, format, *args):
+        logging.debug('Control API: ' + format % args)
+
+    def send_body(self, status: int, body: bytes, content_type: str, etag: str = None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status: int, value):
+        self.send_body(status, json.dumps(value).encode(), self.CONTENT_TYPES['json'])
+
+    def do_GET(self):
+        api = self.server.api
+        url = urlparse(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        if parts == ['state']:
+            self.send_json(200, api.state())
+        elif parts == ['events']:
+            self.stream_events()
+        elif parts == ['reports']:
+            query = parse_qs(url.query)
+            try:
+                offset = int(query.get('offset', ['0'])[0])
+                limit = int(query.get('limit', [str(api.history_size)])[0])
+            except ValueError:
+                self.send_json(400, {'error': 'offset and limit must be integers'})
+                return
+            self.send_json(200, api.report_summaries(max(0, offset), max(0, limit)))
+        elif len(parts) == 2 and parts[0] == 'reports':
+            report_format = parse_qs(url.query).get('format', ['json'])[0]
+            self.send_report(parts[1], report_format)
+        else:
+            self.send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        if urlparse(self.path).path.rstrip('/') == '/start':
+            # the GUI starts the test later, a 'testing' event on /events confirms it
+            if self.server.api.request_start():
+                self.send_json(202, {'accepted': True})
+            else:
+                self.send_json(409, {'accepted': False, 'error': 'A test is already running or requested'})
+        else:
+            self.send_json(404, {'error': 'Not found'})
+
+    def send_report(self, report_id: str, report_format: str):
+        api = self.server.api
+        if report_format not in self.CONTENT_TYPES:
+            self.send_json(400, {'error': 'Unknown format {0}'.format(report_format)})
+            return
+        report_id = api.latest_report_id() if report_id == 'latest' else report_id
+        if report_id is None or not api.has_report(report_id):
+            self.send_json(404, {'error': 'No such report'})
+            return
+        # reports never change, so their id is a strong validator
+        etag = '"{0}-{1}"'.format(report_id, report_format)
+        if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        try:
+            body = api.render_report(report_id, report_format)
+        except KeyError:
+            # purged from the backup folder in the meantime
+            self.send_json(404, {'error': 'No such report'})
+            return
+        except LookupError:
+            self.send_json(404, {'error': 'The raw report is only kept for reports downloaded since startup'})
+            return
+        except Exception:
+            logging.exception('Could not read report {0}.'.format(report_id))
+            self.send_json(500, {'error': 'Could not read report'})
+            return
+        self.send_body(200, body, self.CONTENT_TYPES[report_format], etag)
+
+    def stream_events(self):
+        api = self.server.api
+        events = api.subscribe()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        try:
+            while not api.stopping:
+                try:
+                    kind, value = events.get(timeout=ControlApi.KEEP_ALIVE_INTERVAL)
+                    self.wfile.write('event: {0}\ndata: {1}\n\n'.format(kind, json.dumps(value)).encode())
+                except queue.Empty:
+                    self.wfile.write(b': keep-alive\n\n')
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            api.unsubscribe(events)
+
+
+class ControlApi(QtCore.QObject):
+    """ Local HTTP API that lets PLCs and MES software drive the station
+
+    Requests are served on their own threads and only read state the TestManager already publishes, so they never
+    block the device thread. Starting a test goes through the GUI, exactly like the Start Test button.
+    Reports are read from the single-file backups in the backup folder, plus the ones downloaded since startup, which
+    also have their raw report string. Reports consolidated into workbooks are only available until a restart.
+    """
+
+    start_test_requested = QtCore.pyqtSignal()
+
+    KEEP_ALIVE_INTERVAL = 15
+    SUBSCRIBER_QUEUE_SIZE = 1000
+    XLSX_CACHE_SIZE = 16
+    PARSED_CACHE_SIZE = 1000
+    # a start the GUI did not act on by then, e.g. because a dialog is open, no longer blocks other requests
+    START_CLAIM_TIMEOUT = 5
+    # <report date in ms>-<hash prefix>.xlsx, or <time in ms>.xlsx for backups stored by older versions
+    BACKUP_NAME = re.compile(r'^(\d+)(?:-([0-9a-f]+))?\.xlsx$')
+
+    def __init__(self, test_manager: TestManager, config):
+        super().__init__()
+
+        logging.basicConfig(**config.log_config)
+
+        self.test_manager = test_manager
+        self.history_size = config.api_history
+        self.backup_folder = config.backup_folder
+        self.lock = threading.Lock()
+        # report id -> raw report string of the reports downloaded since startup, oldest first
+        self.reports = OrderedDict()
+        self.parsed_reports = OrderedDict()
+        self.xlsx_cache = OrderedDict()
+        # report id -> backup path, newest first, rescanned when the backup folder changes
+        self.archive = OrderedDict()
+        self.archive_mtime = None
+        self.start_claimed_at = None
+        self.subscribers = set()
+        self.stopping = False
+
+        direct = QtCore.Qt.DirectConnection
+        test_manager.text_feedback.text_feedback_update.connect(lambda text: self.publish('feedback', text), direct)
+        test_manager.status_feedback.status_feedback_update.connect(lambda text: self.publish('status', text), direct)
+        test_manager.start_test_control.set_start_test_enable.connect(self.on_set_start_test_enable, direct)
+        test_manager.communication_error.connect(lambda number: self.publish('communication_error', None), direct)
+        test_manager.report_downloaded.connect(self.on_report_downloaded, direct)
+
+        self.server = ThreadingHTTPServer((config.api_host, config.api_port), ControlRequestHandler)
+        self.server.daemon_threads = True
+        self.server.api = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        logging.info('Control API listening on {0}:{1}'.format(*self.server.server_address))
+
+    def stop(self):
+        self.stopping = True
+        self.server.shutdown()
+        self.server.server_close()
+
+    def subscribe(self):
+        events = queue.Queue(self.SUBSCRIBER_QUEUE_SIZE)
+        with self.lock:
+            self.subscribers.add(events)
+        return events
+
+    def unsubscribe(self, events):
+        with self.lock:
+            self.subscribers.discard(events)
+
+    def publish(self, kind: str, value):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for events in subscribers:
+            try:
+                events.put_nowait((kind, value))
+            except queue.Full:
+                # a client that stopped reading must not slow down the others
+                logging.warning('Dropping control API event for a slow client.')
+
+    def on_set_start_test_enable(self, enabled: bool):
+        with self.lock:
+            self.start_claimed_at = None
+        self.publish('testing', not enabled)
+
+    # ids match the names of the backups, so a report downloaded since startup is not listed twice
+    @staticmethod
+    def report_id(report_string: str):
+        return TestManager.hash_report_string(report_string)[:TestManager.BACKUP_HASH_LENGTH]
+
+    def on_report_downloaded(self, report_string: str):
+        report_id = self.report_id(report_string)
+        with self.lock:
+            self.reports[report_id] = report_string
+            self.reports.move_to_end(report_id)
+            while len(self.reports) > self.history_size:
+                old_id, _ = self.reports.popitem(last=False)
+                self.xlsx_cache.pop(old_id, None)
+        self.publish('report', report_id)
+
+    # claimed under the lock, so of two concurrent requests only one is accepted
+    def request_start(self):
+        with self.lock:
+            now = time.monotonic()
+            if not self.test_manager.start_test_control.enabled:
+                return False
+            if self.start_claimed_at is not None and now - self.start_claimed_at < self.START_CLAIM_TIMEOUT:
+                return False
+            self.start_claimed_at = now
+        self.start_test_requested.emit()
+        return True
+
+    def scan_archive(self):
+        try:
+            mtime = os.stat(self.backup_folder).st_mtime_ns
+            with self.lock:
+                if mtime == self.archive_mtime:
+                    return
+            names = os.listdir(self.backup_folder)
+        except OSError:
+            logging.exception('Could not list the backup folder.')
+            return
+        archive = OrderedDict()
+        # named after the report date, so the newest reports come first
+        for name in sorted(names, reverse=True):
+            match = self.BACKUP_NAME.match(name)
+            if match:
+                archive[match.group(2) or match.group(1)] = os.path.join(self.backup_folder, name)
+        with self.lock:
+            self.archive = archive
+            self.archive_mtime = mtime
+
+    def report_ids(self):
+        self.scan_archive()
+        with self.lock:
+            recent = list(reversed(self.reports))
+            return recent + [report_id for report_id in self.archive if report_id not in self.reports]
+
+    def state(self):
+        return {
+            'testing': not self.test_manager.start_test_control.enabled,
+            'status': self.test_manager.status_feedback.text,
+            'feedback': self.test_manager.text_feedback.text,
+            'latest_report': self.latest_report_id(),
+        }
+
+    def latest_report_id(self):
+        return next(iter(self.report_ids()), None)
+
+    def has_report(self, report_id: str):
+        self.scan_archive()
+        with self.lock:
+            return report_id in self.reports or report_id in self.archive
+
+    # raises KeyError if the report is neither in the history nor in the backup folder
+    def get_report(self, report_id: str):
+        with self.lock:
+            report = self.parsed_reports.get(report_id)
+            report_string = self.reports.get(report_id)
+            path = self.archive.get(report_id)
+        if report is None:
+            if report_string is not None:
+                report = TestReport(report_string)
+            elif path is not None and os.path.exists(path):
+                report = TestReport.from_xlsx(path)
+            else:
+                raise KeyError(report_id)
+            with self.lock:
+                self.parsed_reports[report_id] = report
+                while len(self.parsed_reports) > self.PARSED_CACHE_SIZE:
+                    self.parsed_reports.popitem(last=False)
+        return report
+
+    def report_summaries(self, offset: int, limit: int):
+        summaries = []
+        for report_id in self.report_ids()[offset:offset + limit]:
+            try:
+                report = self.get_report(report_id)
+            except KeyError:
+                continue
+            except Exception:
+                logging.exception('Could not read report {0}, leaving it out.'.format(report_id))
+                continue
+            summaries.append({'id': report_id, 'name': report.name, 'date': report.date.isoformat(),
+                              'verdict': report.verdict})
+        return summaries
+
+    def render_report(self, report_id: str, report_format: str):
+        with self.lock:
+            report_string = self.reports.get(report_id)
+            path = self.archive.get(report_id)
+        if report_format == 'raw':
+            if report_string is None:
+                raise LookupError(report_id)
+            return report_string.encode()
+        report = self.get_report(report_id)
+        if report_format == 'json':
+            return json.dumps(dict(report.as_dict(), id=report_id)).encode()
+        if report_string is None:
+            # the backup is the xlsx file we would build
+            try:
+                with open(path, 'rb') as f:
+                    return f.read()
+            except FileNotFoundError:
+                raise KeyError(report_id)
+        with self.lock:
+            body = self.xlsx_cache.get(report_id)
+        if body is None:
+            body = report.as_xlsx_bytes()
+            with self.lock:
+                self.xlsx_cache[report_id] = body
+                while len(self.xlsx_cache) > self.XLSX_CACHE_SIZE:
+                    self.xlsx_cache.popitem(last=False)
+        return body
@@ -0,0 +1,308 @@
+# coding=UTF-8
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+
+from PyQt5 import QtCore
+
+from custom_libs.schleichore import ActualTestingDevice, FakeTestingDevice, TestManager, TextFeedback, \
+    StatusFeedback, StartTestControl, LoadingIndicator
+from custom_libs.tracing import PhaseTracer
+
+HEARTBEAT_INTERVAL = 1
+# longer than any legitimate pause between two steps of a test, a batch pause excluded
+WORKER_STALL_TIMEOUT = 60
+
+
+def run_worker(connection, config, serial_port):
+    """ Entry point of the device process
+
+    Runs a TestManager without any GUI, forwarding its feedback as (kind, value) tuples over connection and
+    executing the commands received from it. A serial_port of None means a fake device.
+    """
+    if serial_port is None:
+        device = FakeTestingDevice("/dev/DEBUG")
+    else:
+        device = ActualTestingDevice(serial_port, config.operation_timeout, config.stall_threshold)
+    test_manager = TestManager(device, config)
+
+    send_lock = threading.Lock()
+
+    def send(kind, value=None):
+        with send_lock:
+            try:
+                connection.send((kind, value))
+            except (BrokenPipeError, OSError):
+                logging.warning('Could not send {0} event, the GUI process is gone.'.format(kind))
+
+    text_lock = threading.Lock()
+    sent_text = ['']
+
+    # the feedback grows with every line of a test, only what was appended crosses the pipe
+    def send_text(text):
+        with text_lock:
+            if sent_text[0] and text.startswith(sent_text[0]):
+                send('text_append', text[len(sent_text[0]):])
+            else:
+                send('text', text)
+            sent_text[0] = text
+
+    # there is no event loop here, signals must reach the pipe from whichever thread emits them
+    direct = QtCore.Qt.DirectConnection
+    test_manager.text_feedback.text_feedback_update.connect(send_text, direct)
+    test_manager.status_feedback.status_feedback_update.connect(lambda text: send('status', text), direct)
+    test_manager.start_test_control.set_start_test_enable.connect(lambda enabled: send('start_enabled', enabled),
+                                                                  direct)
+    test_manager.loading_indicator.set_loading_indicator_enable.connect(lambda enabled: send('loading', enabled),
+                                                                        direct)
+    test_manager.show_filename_dialog.connect(lambda number: send('filename_dialog'), direct)
+    test_manager.unexpected_shutdown_detected.connect(lambda number: send('unexpected_shutdown'), direct)
+    test_manager.communication_error.connect(lambda number: send('communication_error'), direct)
+    test_manager.report_downloaded.connect(lambda report_string: send('report', report_string), direct)
+
+    # everything that talks to the device runs on this one thread, in the order it was requested
+    device_jobs = queue.Queue()
+    device_busy = threading.Event()
+    test_requested = threading.Event()
+
+    def run_device_jobs():
+        while True:
+            job = device_jobs.get()
+            if job is None:
+                return
+            device_busy.set()
+            test_manager.last_progress = time.monotonic()
+            try:
+                job()
+            except Exception:
+                logging.exception('Device job failed.')
+                send('communication_error')
+            finally:
+                device_busy.clear()
+
+    def run_test():
+        try:
+            test_manager.run()
+        finally:
+            test_requested.clear()
+
+    threading.Thread(target=run_device_jobs, daemon=True).start()
+    # we need to flush the device's cache, otherwise we'll get an old report
+    device_jobs.put(test_manager.flush_reports)
+
+    stall_timeout = WORKER_STALL_TIMEOUT + config.batch_pause
+    last_heartbeat = 0
+    while True:
+        # sent from this loop, so a stuck command loop or a wedged device thread stops the heartbeats
+        now = time.monotonic()
+        if now - last_heartbeat >= HEARTBEAT_INTERVAL:
+            if not device_busy.is_set() or now - test_manager.last_progress < stall_timeout:
+                send('heartbeat')
+            else:
+                logging.error('Device thread made no progress for {0:.0f} s.'
+                              .format(now - test_manager.last_progress))
+            last_heartbeat = now
+        try:
+            if not connection.poll(HEARTBEAT_INTERVAL):
+                continue
+            kind, value = connection.recv()
+        except (EOFError, OSError):
+            logging.warning('GUI process is gone, stopping the device process.')
+            break
+        if kind == 'shutdown':
+            break
+        try:
+            if kind == 'start':
+                if test_requested.is_set():
+                    logging.warning('Ignoring start command, a test is already running or requested.')
+                else:
+                    test_requested.set()
+                    device_jobs.put(run_test)
+            elif kind == 'startup':
+                device_jobs.put(lambda: test_manager.on_startup(1))
+            elif kind == 'reconnect':
+                device_jobs.put(lambda: test_manager.on_reconnect_signal(1))
+            elif kind == 'filename':
+                test_manager.on_filename_available(value)
+            elif kind == 'should_resume':
+                test_manager.on_should_resume(value)
+            elif kind == 'stop_batch':
+                test_manager.stop_batch()
+        except Exception:
+            logging.exception('Could not execute {0} command.'.format(kind))
+            send('communication_error')
+
+    device_jobs.put(None)
+    test_manager.on_shutdown()
+
+
+class ProcessTestManager(QtCore.QObject):
+    """ Stands in for a TestManager running in a separate process
+
+    Exposes the same signals, feedback objects and slots as TestManager, so UiMainWindow can use either.
+    If the device process crashes or stops sending heartbeats, which it also does when its test thread makes no
+    progress, it is restarted and a communication error is shown.
+    """
+
+    show_filename_dialog = QtCore.pyqtSignal(int)
+    unexpected_shutdown_detected = QtCore.pyqtSignal(int)
+    communication_error = QtCore.pyqtSignal(int)
+    report_downloaded = QtCore.pyqtSignal(str)
+
+    HEARTBEAT_TIMEOUT = 10
+    SHUTDOWN_TIMEOUT = 10
+
+    def __init__(self, serial_port, config):
+        super().__init__()
+
+        logging.basicConfig(**config.log_config)
+
+        self.serial_port = serial_port
+        self.config = config
+
+        self.please_resume = False
+        self.text_feedback: TextFeedback = TextFeedback()
+        self.status_feedback: StatusFeedback = StatusFeedback()
+        self.start_test_control: StartTestControl = StartTestControl()
+        self.loading_indicator: LoadingIndicator = LoadingIndicator()
+        # phases are traced by the device process
+        self.tracer = PhaseTracer()
+
+        # spawn, since forking a process that already loaded Qt is not safe
+        self.context = multiprocessing.get_context('spawn')
+        self.process = None
+        self.connection = None
+        self.send_lock = threading.Lock()
+        # commands sent while the process restarts, replayed once the new one runs
+        self.restarting = False
+        self.pending_commands = []
+        self.stopping = False
+
+        self.start_process()
+        self.reader = threading.Thread(target=self.read_events, daemon=True)
+        self.reader.start()
+
+    def start_process(self):
+        self.connection, child_connection = self.context.Pipe()
+        self.process = self.context.Process(target=run_worker, args=(child_connection, self.config, self.serial_port),
+                                            daemon=True)
+        self.process.start()
+        child_connection.close()
+        logging.info('Device process started with pid {0}.'.format(self.process.pid))
+
+    # must be called with send_lock held
+    def send_now(self, kind, value=None):
+        try:
+            self.connection.send((kind, value))
+        except (BrokenPipeError, OSError):
+            logging.warning('Could not send {0} command, the device process is gone.'.format(kind))
+
+    def send(self, kind, value=None):
+        with self.send_lock:
+            if self.restarting:
+                self.pending_commands.append((kind, value))
+            else:
+                self.send_now(kind, value)
+
+    def restart_process(self, reason: str):
+        logging.error('Device process {0}, restarting it.'.format(reason))
+        with self.send_lock:
+            self.restarting = True
+            process, connection = self.process, self.connection
+            if process.is_alive():
+                # gives the process a chance to flush its buffered backups and reports
+                self.send_now('shutdown')
+        # waited for outside the lock, so the GUI thread never blocks on it
+        # the new process only starts afterwards, since both would use the same serial port and workbooks
+        process.join(self.SHUTDOWN_TIMEOUT)
+        if process.is_alive():
+            logging.warning('Device process did not stop in time, terminating it.')
+            process.terminate()
+            process.join(self.SHUTDOWN_TIMEOUT)
+        if process.is_alive():
+            process.kill()
+            process.join()
+        connection.close()
+        # before the replayed commands, which may start a test again
+        self.start_test_control.enable()
+        self.loading_indicator.disable()
+        self.communication_error.emit(1)
+        with self.send_lock:
+            self.start_process()
+            self.send_now('startup')
+            for kind, value in self.pending_commands:
+                self.send_now(kind, value)
+            self.pending_commands = []
+            self.restarting = False
+
+    def dispatch(self, kind, value):
+        if kind == 'text':
+            self.text_feedback.set_text(value)
+        elif kind == 'text_append':
+            self.text_feedback.append(value)
+        elif kind == 'status':
+            self.status_feedback.set_text(value)
+        elif kind == 'start_enabled':
+            if value:
+                self.start_test_control.enable()
+            else:
+                self.start_test_control.disable()
+        elif kind == 'loading':
+            if value:
+                self.loading_indicator.enable()
+            else:
+                self.loading_indicator.disable()
+        elif kind == 'filename_dialog':
+            self.show_filename_dialog.emit(1)
+        elif kind == 'unexpected_shutdown':
+            self.unexpected_shutdown_detected.emit(1)
+        elif kind == 'communication_error':
+            self.communication_error.emit(1)
+        elif kind == 'report':
+            self.report_downloaded.emit(value)
+
+    def read_events(self):
+        while not self.stopping:
+            try:
+                if not self.connection.poll(self.HEARTBEAT_TIMEOUT):
+                    if not self.stopping:
+                        self.restart_process('stopped responding')
+                    continue
+                kind, value = self.connection.recv()
+            except (EOFError, OSError):
+                if not self.stopping:
+                    self.restart_process('crashed')
+                continue
+            self.dispatch(kind, value)
+
+    def start(self):
+        self.send('start')
+
+    def stop_batch(self):
+        self.send('stop_batch')
+
+    def on_reconnect_signal(self, number: int):
+        self.send('reconnect')
+
+    def on_startup(self, number: int):
+        self.send('startup')
+
+    def on_filename_available(self, filename: str):
+        self.send('filename', filename)
+
+    def on_should_resume(self, should_resume: bool):
+        self.send('should_resume', bool(should_resume))
+        # the answer reaches the device process too late for init_app to notice, so we resume from here
+        if should_resume:
+            self.please_resume = True
+            self.start()
+
+    def on_shutdown(self):
+        self.stopping = True
+        self.send('shutdown')
+        self.process.join(self.SHUTDOWN_TIMEOUT)
+        if self.process.is_alive():
+            logging.warning('Device process did not stop in time, terminating it.')
+            self.process.terminate()
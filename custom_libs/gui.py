@@ -23,6 +23,8 @@ class UiMainWindow(QtCore.QObject):
         self.central_widget = None
         self.vertical_layout = None
         self.start_test_button = None
+        self.stop_batch_button = None
+        self.trigger_shortcut = None
         self.text_box = None
         self.status_labels = None
         self.loading_icon = None
@@ -36,6 +38,9 @@ class UiMainWindow(QtCore.QObject):
         self.communication_error = False
 
         self.default_reports_folder = config.default_reports_folder
+        self.batch_mode = config.batch_mode
+        self.batch_trigger = config.batch_trigger
+        self.batch_trigger_key = config.batch_trigger_key
 
     def on_text_feedback_update(self, new_text: str):
         self.text_box.setText(new_text)
@@ -53,10 +58,20 @@ class UiMainWindow(QtCore.QObject):
     def on_set_start_test_enable(self, enabled: bool):
         self.start_test_button.setEnabled(enabled)
 
+    def on_trigger_key(self):
+        if self.start_test_button.isEnabled():
+            self.action_start_test.trigger()
+
+    def on_start_test(self):
+        # the test thread only begins the cycle this press starts once it runs
+        self.test_manager.tracer.instant('start button', cycle=self.test_manager.tracer.cycle + 1)
+        self.test_manager.start()
+
     def on_show_filename_dialog(self, number: int):
-        dialog = QtWidgets.QFileDialog.getSaveFileName(None, 'Save Report',
-                                                          '{0}report-{1}.xlsx'.format(self.default_reports_folder, int(time.time() * 1000)),
-                                                          filter='*.xlsx')
+        with self.test_manager.tracer.phase('dialog wait'):
+            dialog = QtWidgets.QFileDialog.getSaveFileName(None, 'Save Report',
+                                                              '{0}report-{1}.xlsx'.format(self.default_reports_folder, int(time.time() * 1000)),
+                                                              filter='*.xlsx')
         self.last_filename = dialog[0]
         self.filename_available.emit(self.last_filename)
 
@@ -95,6 +110,13 @@ class UiMainWindow(QtCore.QObject):
         self.start_test_button.setObjectName("startTestButton")
         self.vertical_layout.addWidget(self.start_test_button)
 
+        if self.batch_mode and self.batch_trigger == 'continuous':
+            self.stop_batch_button = QtWidgets.QPushButton(self.central_widget)
+            self.stop_batch_button.setMinimumSize(QtCore.QSize(0, 60))
+            self.stop_batch_button.setFont(font)
+            self.stop_batch_button.setObjectName("stopBatchButton")
+            self.vertical_layout.addWidget(self.stop_batch_button)
+
         self.test_manager.start_test_control.set_start_test_enable.connect(self.on_set_start_test_enable)
 
         self.text_box = QtWidgets.QTextEdit(self.central_widget)
@@ -149,14 +171,21 @@ class UiMainWindow(QtCore.QObject):
         self.reconnect.connect(self.test_manager.on_reconnect_signal)
 
         self.retranslate_ui(main_window)
-        self.action_start_test.trigger = self.test_manager.start
+        self.action_start_test.trigger = self.on_start_test
         self.start_test_button.released.connect(self.action_start_test.trigger)
+        if self.stop_batch_button is not None:
+            self.stop_batch_button.released.connect(self.test_manager.stop_batch)
+        if self.batch_mode:
+            self.trigger_shortcut = QtWidgets.QShortcut(QtGui.QKeySequence(self.batch_trigger_key), main_window)
+            self.trigger_shortcut.activated.connect(self.on_trigger_key)
         QtCore.QMetaObject.connectSlotsByName(main_window)
 
     def retranslate_ui(self, MainWindow):
         _translate = QtCore.QCoreApplication.translate
         MainWindow.setWindowTitle(_translate("MainWindow", "Schleich Report Downloader"))
         self.start_test_button.setText(_translate("MainWindow", "Start Test"))
+        if self.stop_batch_button is not None:
+            self.stop_batch_button.setText(_translate("MainWindow", "Stop Batch"))
         self.text_box.setHtml(_translate("MainWindow", "<!DOCTYPE HTML PUBLIC \"-//W3C//DTD HTML 4.0//EN\" \"http://www.w3.org/TR/REC-html40/strict.dtd\">\n"
 "<html><head><meta name=\"qrichtext\" content=\"1\" /><style type=\"text/css\">\n"
 "p, li { white-space: pre-wrap; }\n"
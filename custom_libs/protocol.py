@@ -0,0 +1,151 @@
+# coding=UTF-8
+from enum import Enum
+
+STX = 0x02
+ETX = 0x03
+ACK = 0x06
+BEL = 0x07
+NAK = 0x15
+
+IDENTIFICATION_MARKER = b'Conness.'
+REPORT_MARKER = b'NUM_1'
+REPORT_NAME_MARKER = b'NAME_'
+REPORT_DATE_MARKER = b'DA_'
+
+# the device answers a report request with a combination of these when its cache is empty
+EMPTY_REPORT_FILLER = bytes([BEL, NAK, ETX]) + b'24'
+# stray bytes the device sometimes adds to its answers, e.g. b' \x81\n' for an empty cache
+NON_ASCII = bytes(range(0x80, 0x100))
+# tolerated around a frame, STX excluded since it would start another frame
+NOISE = bytes(byte for byte in range(0x20) if byte != STX) + b' ' + NON_ASCII
+
+# the checksum rule is inferred from the commands we send, answers are only checked once it is confirmed against
+# answers captured from a device
+VERIFY_CHECKSUM = False
+
+
+class FrameType(Enum):
+    ACK = 'ack'
+    BEL = 'bel'
+    NAK = 'nak'
+    EMPTY = 'empty'
+    REPORT = 'report'
+    IDENTIFICATION = 'identification'
+    UNKNOWN = 'unknown'
+
+
+class FrameError(ValueError):
+    pass
+
+
+class Frame:
+    """ A response received from the GLP2-e
+
+    frame_type: A FrameType
+    raw: The bytes as they were read from the device
+    payload: The meaningful part of raw, e.g. the identification string without framing
+    """
+
+    def __init__(self, frame_type: FrameType, raw: bytes, payload: bytes = b''):
+        self.frame_type = frame_type
+        self.raw = raw
+        self.payload = payload
+
+    def text(self):
+        return self.payload.decode(errors='ignore')
+
+    def __repr__(self):
+        return 'Frame({0}, {1!r})'.format(self.frame_type.name, self.raw)
+
+
+def checksum(data: bytes):
+    """ XOR of every byte from STX up to the checksum, as two uppercase hex digits
+
+    e.g. b'\\x02\\x81\\xfab ' -> b'3B', the checksum of ActualTestingDevice.BEEP_COMMAND
+    """
+    value = 0
+    for byte in data:
+        value ^= byte
+    return '{0:02X}'.format(value).encode()
+
+
+def encode(body: bytes):
+    data = bytes([STX]) + body
+    return data + checksum(data) + bytes([ETX])
+
+
+def check_framing(data: bytes):
+    """ Raises FrameError if data holds a malformed STX ... ETX frame
+
+    Control, whitespace and non-ASCII bytes around the frame are ignored. Answers without a complete STX ... ETX span
+    are accepted unframed, like the string checks that came before the codec did.
+    """
+    start = data.find(bytes([STX]))
+    end = data.find(bytes([ETX]), start + 1) if start >= 0 else -1
+    if end < 0:
+        return
+    if data.find(bytes([STX]), start + 1, end) >= 0:
+        raise FrameError('Frame contains more than one STX.')
+    if data[:start].translate(None, NOISE) or data[end + 1:].translate(None, NOISE):
+        raise FrameError('Unexpected bytes around the frame: {0!r}'.format(data[:start] + b'...' + data[end + 1:]))
+    if VERIFY_CHECKSUM:
+        expected = checksum(data[start:end - 2])
+        if data[end - 2:end] != expected:
+            raise FrameError('Frame checksum is {0!r}, expected {1!r}.'.format(data[end - 2:end], expected))
+
+
+def _decode_control(data: bytes):
+    frame_type = CONTROL_FRAMES.get(data.translate(None, NON_ASCII))
+    if frame_type is None:
+        return None
+    return Frame(frame_type, data)
+
+
+def _decode_report(data: bytes):
+    marker = data.find(REPORT_MARKER)
+    if marker < 0:
+        return None
+    tail = data[marker + len(REPORT_MARKER):]
+    if REPORT_NAME_MARKER not in tail or REPORT_DATE_MARKER not in tail:
+        raise FrameError('Report frame is missing its name or date field.')
+    check_framing(data)
+    return Frame(FrameType.REPORT, data, data)
+
+
+def _decode_identification(data: bytes):
+    marker = data.find(IDENTIFICATION_MARKER)
+    if marker < 0:
+        return None
+    check_framing(data)
+    # the identification string is preceded by three framing characters, counted after dropping the bytes that are
+    # not valid UTF-8 as the device class always did, since the string is compared on reconnect
+    return Frame(FrameType.IDENTIFICATION, data, data[:marker].decode(errors='ignore')[3:].encode())
+
+
+def _decode_empty(data: bytes):
+    if len(data.translate(None, EMPTY_REPORT_FILLER + NON_ASCII).strip()) > 0:
+        return None
+    return Frame(FrameType.EMPTY, data)
+
+
+CONTROL_FRAMES = {
+    bytes([ACK]): FrameType.ACK,
+    bytes([BEL]): FrameType.BEL,
+    bytes([NAK]): FrameType.NAK,
+}
+
+# tried in order, the first decoder returning a frame wins
+DECODERS = [
+    _decode_control,
+    _decode_empty,
+    _decode_report,
+    _decode_identification,
+]
+
+
+def decode(data: bytes):
+    for decoder in DECODERS:
+        frame = decoder(data)
+        if frame is not None:
+            return frame
+    return Frame(FrameType.UNKNOWN, data, data)
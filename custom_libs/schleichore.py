@@ -1,18 +1,26 @@
 # coding=UTF-8
 from abc import ABC, abstractmethod
 
+import cProfile
 import datetime
+import hashlib
+import io
 import logging
 import os
+import threading
 import time
+from collections import OrderedDict
 from pathlib import Path
 
 import serial
 from PyQt5 import QtCore
-from openpyxl import Workbook
+from openpyxl import Workbook, load_workbook
 from openpyxl.styles import Font
 from openpyxl.utils import get_column_letter
 
+from custom_libs import protocol
+from custom_libs.tracing import PhaseTracer
+
 
 def as_text(value):
     if value is None:
@@ -24,6 +32,33 @@ class NoReportException(Exception):
     pass
 
 
+# subclassing serial's exceptions lets callers handle stalls like any other communication error
+class DeviceTimeoutException(serial.SerialTimeoutException):
+    pass
+
+
+class OperationCancelledException(serial.SerialException):
+    pass
+
+
+class CancellationToken:
+    """ Allows a device operation to be aborted from another thread """
+
+    def __init__(self):
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise OperationCancelledException('Device operation was cancelled.')
+
+
 class TestReport:
     """ Represents a report
 
@@ -40,7 +75,11 @@ class TestReport:
     }
     """
 
+    STEP_HEADERS = ['Step Number', 'Method', 'Step Name', 'Limit Value', 'Actual Value', 'Test Condition',
+                    'Actual Condition', 'Test Duration', 'Go']
+
     def __init__(self, report_string):
+        self.raw = report_string
         result = report_string.split('NUM_1')
         test_info = result[1].split(' ')
         self.name = test_info[1].replace('NAME_', '').replace('*', ' ')
@@ -65,50 +104,59 @@ class TestReport:
                 parsed_step['go'] = 'GO' if parsed_step['actual_value'] <= parsed_step['limit_value'] else 'NGO'
                 self.steps_with_results.append(parsed_step)
 
-    def store_as_xlsx(self, name):
-        wb = Workbook()
+    @property
+    def verdict(self):
+        return 'GO' if all(step['go'] == 'GO' for step in self.steps_with_results) else 'NGO'
 
+    @classmethod
+    def from_xlsx(cls, path):
+        """ Reads back a report stored by store_as_xlsx. The raw report string is not available (raw is None). """
+        wb = load_workbook(path, read_only=True)
+        try:
+            rows = list(wb.active.iter_rows(values_only=True))
+        finally:
+            wb.close()
+
+        report = cls.__new__(cls)
+        report.raw = None
+        report.name = rows[1][0]
+        report.date = rows[1][1]
+        report.steps_with_results = []
+        for row in rows[4:]:
+            if not row or row[0] is None:
+                break
+            # values were stored with their unit, e.g. '5.0 mA'
+            report.steps_with_results.append({
+                'name': row[2],
+                'method': row[1],
+                'test_condition': float(str(row[5]).split(' ')[0]),
+                'limit_value': float(str(row[3]).split(' ')[0]),
+                'actual_condition': float(str(row[6]).split(' ')[0]),
+                'actual_value': float(str(row[4]).split(' ')[0]),
+                'test_duration': float(str(row[7]).split(' ')[0]),
+                'go': row[8],
+            })
+        return report
+
+    # writes the report as a block of rows starting at first_row, returns the first row after the block
+    def write_to_worksheet(self, ws, first_row=1):
         bold_font = Font(bold=True)
 
-        dest_filename = name if name.endswith('.xlsx') else f'{name}.xlsx'
+        ws.cell(column=1, row=first_row, value='Preset Name').font = bold_font
+        ws.cell(column=2, row=first_row, value='Date').font = bold_font
 
-        ws1 = wb.active
-        ws1.title = "Test Report"
+        ws.cell(column=1, row=first_row + 1, value=self.name)
+        ws.cell(column=2, row=first_row + 1, value=self.date)
 
-        ws1['A1'] = 'Preset Name'
-        ws1['B1'] = 'Date'
-        ws1['A1'].font = bold_font
-        ws1['B1'].font = bold_font
-
-        ws1['A2'] = self.name
-        ws1['B2'] = self.date
-
-        ws1['A4'] = 'Step Number'
-        ws1['B4'] = 'Method'
-        ws1['C4'] = 'Step Name'
-        ws1['D4'] = 'Limit Value'
-        ws1['E4'] = 'Actual Value'
-        ws1['F4'] = 'Test Condition'
-        ws1['G4'] = 'Actual Condition'
-        ws1['H4'] = 'Test Duration'
-        ws1['I4'] = 'Go'
-
-        ws1['A4'].font = bold_font
-        ws1['B4'].font = bold_font
-        ws1['C4'].font = bold_font
-        ws1['D4'].font = bold_font
-        ws1['E4'].font = bold_font
-        ws1['F4'].font = bold_font
-        ws1['G4'].font = bold_font
-        ws1['H4'].font = bold_font
-        ws1['I4'].font = bold_font
-
-        row = 5
+        for col, header in enumerate(self.STEP_HEADERS, start=1):
+            ws.cell(column=col, row=first_row + 3, value=header).font = bold_font
+
+        row = first_row + 4
         for step in self.steps_with_results:
             for col in range(1, len(step) + 2):
                 value = 0
                 if col == 1:
-                    value = row - 4
+                    value = row - first_row - 3
                 if col == 2:
                     value = step['method']
                 elif col == 3:
@@ -125,8 +173,34 @@ class TestReport:
                     value = str(step['test_duration']) + ' s'
                 elif col == 9:
                     value = step['go']
-                _ = ws1.cell(column=col, row=row, value=value)
+                _ = ws.cell(column=col, row=row, value=value)
             row += 1
+        return row
+
+    def store_as_xlsx(self, name):
+        dest_filename = name if name.endswith('.xlsx') else f'{name}.xlsx'
+        self.build_workbook().save(filename=dest_filename)
+
+    def as_xlsx_bytes(self):
+        buffer = io.BytesIO()
+        self.build_workbook().save(buffer)
+        return buffer.getvalue()
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'date': self.date.isoformat(),
+            'verdict': self.verdict,
+            'steps': self.steps_with_results,
+        }
+
+    def build_workbook(self):
+        wb = Workbook()
+
+        ws1 = wb.active
+        ws1.title = "Test Report"
+
+        self.write_to_worksheet(ws1)
 
         column_widths = []
         for row in ws1.iter_rows():
@@ -139,7 +213,7 @@ class TestReport:
         for i, column_width in enumerate(column_widths):
             ws1.column_dimensions[get_column_letter(i + 1)].width = column_width + 5
 
-        wb.save(filename=dest_filename)
+        return wb
 
     def __str__(self):
         string = ''
@@ -149,6 +223,105 @@ class TestReport:
         return string
 
 
+class RollingWorkbookStore:
+    """ Appends reports to one workbook per day or per preset instead of writing one file per report
+
+    Workbooks are kept in memory and written to disk every flush_every reports and on shutdown. Up to max_open of the
+    most recently used workbooks stay in memory after a flush, so alternating presets are not reloaded from disk.
+    Each workbook has a Summary sheet with a row per report and a Reports sheet with a block of rows per report.
+    """
+
+    MODES = ('daily', 'preset')
+    SUMMARY_SHEET_TITLE = 'Summary'
+    REPORTS_SHEET_TITLE = 'Reports'
+    SUMMARY_HEADERS = ['Preset Name', 'Date', 'Verdict', 'Steps', 'First Row']
+    COLUMN_WIDTH = 20
+    MAX_OPEN_WORKBOOKS = 16
+
+    def __init__(self, folder: str, mode: str, flush_every: int, prefix: str, max_open: int = MAX_OPEN_WORKBOOKS):
+        self.folder = folder
+        self.mode = mode
+        self.flush_every = max(1, flush_every)
+        self.prefix = prefix
+        self.max_open = max(1, max_open)
+        # least recently used first
+        self.workbooks = OrderedDict()
+        self.dirty = set()
+        self.pending = 0
+        self.last_path = None
+        # called once the reports appended since the last flush are on disk
+        self.on_stored_callbacks = []
+        # appends happen on the worker thread, the final flush on the GUI thread
+        self.lock = threading.Lock()
+
+    def workbook_path(self, report: TestReport):
+        if self.mode == 'daily':
+            key = report.date.strftime('%Y-%m-%d')
+        else:
+            key = report.name.strip().replace(os.sep, '-')
+        return os.path.join(self.folder, '{0}-{1}.xlsx'.format(self.prefix, key))
+
+    def new_workbook(self):
+        wb = Workbook()
+        bold_font = Font(bold=True)
+        summary = wb.active
+        summary.title = self.SUMMARY_SHEET_TITLE
+        for col, header in enumerate(self.SUMMARY_HEADERS, start=1):
+            summary.cell(column=col, row=1, value=header).font = bold_font
+        reports = wb.create_sheet(self.REPORTS_SHEET_TITLE)
+        for ws in (summary, reports):
+            for col in range(1, len(TestReport.STEP_HEADERS) + 1):
+                ws.column_dimensions[get_column_letter(col)].width = self.COLUMN_WIDTH
+        return wb
+
+    def get_workbook(self, path: str):
+        if path not in self.workbooks:
+            self.workbooks[path] = load_workbook(path) if os.path.exists(path) else self.new_workbook()
+        self.workbooks.move_to_end(path)
+        return self.workbooks[path]
+
+    def append(self, report: TestReport, on_stored=None):
+        with self.lock:
+            path = self.workbook_path(report)
+            wb = self.get_workbook(path)
+            summary = wb[self.SUMMARY_SHEET_TITLE]
+            reports = wb[self.REPORTS_SHEET_TITLE]
+            # leave an empty row between blocks
+            first_row = reports.max_row + 2 if reports.max_row > 1 else 1
+            report.write_to_worksheet(reports, first_row)
+            summary.append([report.name, report.date, report.verdict, len(report.steps_with_results), first_row])
+            self.dirty.add(path)
+            self.last_path = path
+            self.pending += 1
+            if on_stored is not None:
+                self.on_stored_callbacks.append(on_stored)
+            if self.pending >= self.flush_every:
+                self._flush()
+        return path
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def open_paths(self):
+        with self.lock:
+            return set(self.workbooks)
+
+    def _flush(self):
+        for path in self.dirty:
+            # an interrupted save must not leave a truncated workbook behind
+            self.workbooks[path].save(filename=path + '.tmp')
+            os.replace(path + '.tmp', path)
+        logging.debug('{0} reports written to {1} consolidated workbooks.'.format(self.pending, len(self.dirty)))
+        self.dirty.clear()
+        self.pending = 0
+        callbacks, self.on_stored_callbacks = self.on_stored_callbacks, []
+        for callback in callbacks:
+            callback()
+        while len(self.workbooks) > self.max_open:
+            self.workbooks.popitem(last=False)
+
+
 class TestingDevice(ABC):
 
     @abstractmethod
@@ -160,39 +333,55 @@ class TestingDevice(ABC):
         pass
 
     @abstractmethod
-    def send_custom_command(self, command_hex):
+    def check_for_stall(self):
         pass
 
     @abstractmethod
-    def read_all(self):
+    def send_custom_command(self, command_hex, deadline=None, token=None):
         pass
 
     @abstractmethod
-    def beep(self):
+    def read_all_bytes(self, deadline=None, token=None):
         pass
 
     @abstractmethod
-    def identify(self):
+    def read_all(self, deadline=None, token=None):
         pass
 
     @abstractmethod
-    def get_first_available_report(self):
+    def beep(self, deadline=None, token=None):
         pass
 
     @abstractmethod
-    def get_all_reports(self):
+    def identify(self, deadline=None, token=None):
         pass
 
     @abstractmethod
-    def is_testing(self):
+    def get_first_available_report_string(self, deadline=None, token=None):
         pass
 
     @abstractmethod
-    def start_test(self):
+    def get_first_available_report(self, deadline=None, token=None):
+        pass
+
+    @abstractmethod
+    def get_all_report_strings(self, deadline=None, token=None):
+        pass
+
+    @abstractmethod
+    def get_all_reports(self, deadline=None, token=None):
+        pass
+
+    @abstractmethod
+    def is_testing(self, deadline=None, token=None):
         pass
 
     @abstractmethod
-    def clear_all_reports(self):
+    def start_test(self, deadline=None, token=None):
+        pass
+
+    @abstractmethod
+    def clear_all_reports(self, deadline=None, token=None):
         pass
 
     @abstractmethod
@@ -205,35 +394,49 @@ class FakeTestingDevice(TestingDevice):
     def __init__(self, serial_port: str):
         self.port = serial_port
         self.id_string = "DEBUG DEVICE"
+        self.stall_count = 0
+        self.stall_durations = []
 
     def reconnect(self):
-        pass
+        return True
 
-    def send_custom_command(self, command_hex):
-        pass
+    def check_for_stall(self):
+        return False
 
-    def read_all(self):
+    def send_custom_command(self, command_hex, deadline=None, token=None):
         pass
 
-    def beep(self):
-        pass
+    def read_all_bytes(self, deadline=None, token=None):
+        return b''
 
-    def identify(self):
+    def read_all(self, deadline=None, token=None):
         pass
 
-    def get_first_available_report(self):
+    def beep(self, deadline=None, token=None):
         pass
 
-    def get_all_reports(self):
+    def identify(self, deadline=None, token=None):
         pass
 
-    def is_testing(self):
+    def get_first_available_report_string(self, deadline=None, token=None):
+        raise NoReportException('No report available for download.')
+
+    def get_first_available_report(self, deadline=None, token=None):
+        raise NoReportException('No report available for download.')
+
+    def get_all_report_strings(self, deadline=None, token=None):
+        return []
+
+    def get_all_reports(self, deadline=None, token=None):
+        return []
+
+    def is_testing(self, deadline=None, token=None):
         pass
 
-    def start_test(self):
+    def start_test(self, deadline=None, token=None):
         pass
 
-    def clear_all_reports(self):
+    def clear_all_reports(self, deadline=None, token=None):
         pass
 
     def close_communication(self):
@@ -247,12 +450,30 @@ class ActualTestingDevice(TestingDevice):
     GET_REPORT_COMMAND = [0x02, 0x81, 0x06]
     START_TEST_COMMAND = [0x02, 0x81, 0xfa, 0x73, 0x20, 0x32, 0x41, 0x03]
 
-    def __init__(self, serial_port: str):
+    # seconds
+    OPERATION_TIMEOUT = 5
+    STALL_THRESHOLD = 3
+
+    def __init__(self, serial_port: str, operation_timeout: float = OPERATION_TIMEOUT,
+                 stall_threshold: float = STALL_THRESHOLD):
         self.port = serial_port
-        self.ser = serial.Serial(serial_port, baudrate=9600, timeout=None, parity=serial.PARITY_NONE,
-                                 bytesize=serial.EIGHTBITS, stopbits=serial.STOPBITS_ONE, xonxoff=False)
+        self.operation_timeout = operation_timeout
+        self.stall_threshold = stall_threshold
+        self.ser = self.open_serial(serial_port)
         self.id_string = ""
 
+        self.current_token = CancellationToken()
+        # monotonic timestamp of the serial call in progress, None when idle
+        self.io_started_at = None
+        self.io_stalled = False
+        self.stall_count = 0
+        self.stall_durations = []
+
+    def open_serial(self, serial_port: str):
+        return serial.Serial(serial_port, baudrate=9600, timeout=self.stall_threshold,
+                             write_timeout=self.stall_threshold, parity=serial.PARITY_NONE,
+                             bytesize=serial.EIGHTBITS, stopbits=serial.STOPBITS_ONE, xonxoff=False)
+
     def reconnect(self):
         logging.debug('Trying to reconnect...')
         self.ser.close()
@@ -265,7 +486,8 @@ class ActualTestingDevice(TestingDevice):
             while i < 100:
                 try:
                     i += 1
-                    device = ActualTestingDevice(base_serial_string + str(i))
+                    device = ActualTestingDevice(base_serial_string + str(i), self.operation_timeout,
+                                                 self.stall_threshold)
                     id_string = device.identify()
                     # this may need to be improved by actually checking the response
                     if id_string == self.id_string:
@@ -276,83 +498,176 @@ class ActualTestingDevice(TestingDevice):
                     logging.exception('Unknown exception while searching for testing device.')
             if i < 100:
                 self.port = base_serial_string + str(i)
-                self.ser = serial.Serial(self.port, baudrate=9600, timeout=None, parity=serial.PARITY_NONE,
-                                    bytesize=serial.EIGHTBITS, stopbits=serial.STOPBITS_ONE, xonxoff=False)
+                self.ser = self.open_serial(self.port)
                 logging.info('Succesfully reconnected on {0}'.format(self.port))
-
-    def send_custom_command(self, command_hex):
+        return self.ser.is_open
+
+    # returns the deadline and cancellation token to use for an operation, creating them if not given
+    def begin_operation(self, deadline=None, token=None):
+        if deadline is None:
+            deadline = time.monotonic() + self.operation_timeout
+        if token is None:
+            token = CancellationToken()
+        self.current_token = token
+        return deadline, token
+
+    @staticmethod
+    def check_deadline(deadline, token):
+        token.raise_if_cancelled()
+        if time.monotonic() > deadline:
+            raise DeviceTimeoutException('Device operation exceeded its deadline.')
+
+    def begin_io(self):
+        self.io_started_at = time.monotonic()
+
+    def end_io(self):
+        if self.io_stalled:
+            duration = time.monotonic() - self.io_started_at
+            self.stall_durations.append(duration)
+            logging.warning('Stalled device I/O returned after {0:.2f} s.'.format(duration))
+            self.io_stalled = False
+        self.io_started_at = None
+
+    def check_for_stall(self):
+        started_at = self.io_started_at
+        if started_at is None or self.io_stalled or time.monotonic() - started_at < self.stall_threshold:
+            return False
+        self.io_stalled = True
+        self.stall_count += 1
+        logging.warning('Device I/O on {0} stalled, aborting it ({1} stalls so far).'.format(self.port, self.stall_count))
+        self.current_token.cancel()
+        try:
+            self.ser.cancel_read()
+            self.ser.cancel_write()
+        except (AttributeError, serial.SerialException, OSError):
+            logging.exception('Could not abort stalled device I/O.')
+        return True
+
+    def send_custom_command(self, command_hex, deadline=None, token=None):
+        deadline, token = self.begin_operation(deadline, token)
+        self.check_deadline(deadline, token)
         try:
+            self.begin_io()
             self.ser.write(serial.to_bytes(command_hex))
         except serial.SerialException or OSError as e:
             logging.exception('Exception while writing command. Maybe the device was disconnected?')
             raise e
+        finally:
+            self.end_io()
+        token.raise_if_cancelled()
         time.sleep(0.12)
 
-    def read_all(self):
-        read_data = ''
+    def read_all_bytes(self, deadline=None, token=None):
+        deadline, token = self.begin_operation(deadline, token)
+        read_data = b''
         try:
+            self.check_deadline(deadline, token)
             while self.ser.in_waiting > 0:
                 try:
-                    new_data = self.ser.read(self.ser.in_waiting)
-                    read_data += new_data.decode(errors='ignore')
+                    self.begin_io()
+                    read_data += self.ser.read(self.ser.in_waiting)
                 except serial.SerialException or OSError as e:
                     logging.exception('Exception while reading from serial device. Maybe it was disconnected?')
                     raise e
                 except TypeError:
                     continue
+                finally:
+                    self.end_io()
+                self.check_deadline(deadline, token)
                 time.sleep(0.12)
         except serial.SerialException or OSError as e:
             logging.exception('Exception while reading from serial device. Maybe it was disconnected?')
             raise e
         if len(read_data.strip()) > 0:
-            logging.debug('Read {0} bytes from device: {1}'.format(len(read_data), ":".join("{:02x}".format(ord(c)) for c in read_data)))
+            logging.debug('Read {0} bytes from device: {1}'.format(len(read_data), ":".join("{:02x}".format(b) for b in read_data)))
         return read_data
 
-    def beep(self):
-        self.send_custom_command(ActualTestingDevice.BEEP_COMMAND)
+    def read_all(self, deadline=None, token=None):
+        return self.read_all_bytes(deadline, token).decode(errors='ignore')
+
+    def read_frame(self, deadline=None, token=None):
+        return protocol.decode(self.read_all_bytes(deadline, token))
+
+    def beep(self, deadline=None, token=None):
+        self.send_custom_command(ActualTestingDevice.BEEP_COMMAND, deadline, token)
 
-    def identify(self):
+    def identify(self, deadline=None, token=None):
+        deadline, token = self.begin_operation(deadline, token)
         logging.debug('Requesting identification.')
-        self.send_custom_command(ActualTestingDevice.IDENTIFY_COMMAND)
-        id_string = self.read_all()
-        id_string = (id_string.split("Conness.")[0])[3:]
+        self.send_custom_command(ActualTestingDevice.IDENTIFY_COMMAND, deadline, token)
+        frame = self.read_frame(deadline, token)
+        id_string = frame.text() if frame.frame_type == protocol.FrameType.IDENTIFICATION else ''
         self.id_string = id_string
         logging.debug('Device identifies as {0}'.format(self.id_string))
         return id_string
 
-    def get_first_available_report(self):
-        self.send_custom_command(ActualTestingDevice.GET_REPORT_COMMAND)
-        result = self.read_all()
-        if len(result.strip().replace('\x07', '').replace('\x15', '').replace('4', '').replace('\x03', '').replace('2', '')) == 0:
+    def get_first_available_report_string(self, deadline=None, token=None):
+        deadline, token = self.begin_operation(deadline, token)
+        self.send_custom_command(ActualTestingDevice.GET_REPORT_COMMAND, deadline, token)
+        frame = self.read_frame(deadline, token)
+        if frame.frame_type == protocol.FrameType.UNKNOWN:
+            raise protocol.FrameError('Unexpected response to report request: {0!r}'.format(frame.raw))
+        if frame.frame_type != protocol.FrameType.REPORT:
             raise NoReportException('No report available for download.')
-        return TestReport(result)
+        return frame.text()
 
-    def get_all_reports(self):
-        reports = []
+    def get_first_available_report(self, deadline=None, token=None):
+        return TestReport(self.get_first_available_report_string(deadline, token))
+
+    # downloads every report in the device's cache without parsing it
+    # a deadline, if given, covers the whole drain, otherwise each report gets its own operation timeout
+    def get_all_report_strings(self, deadline=None, token=None):
+        report_strings = []
         while True:
             try:
-                reports.append(self.get_first_available_report())
+                report_strings.append(self.get_first_available_report_string(deadline, token))
             except NoReportException:
-                return reports
+                return report_strings
+
+    def get_all_reports(self, deadline=None, token=None):
+        return [TestReport(report_string) for report_string in self.get_all_report_strings(deadline, token)]
 
-    def is_testing(self):
-        self.beep()
+    def is_testing(self, deadline=None, token=None):
+        deadline, token = self.begin_operation(deadline, token)
+        self.beep(deadline, token)
         time.sleep(0.12)
-        result = self.read_all()
-        # some magic conversion
-        return (":".join("{:02x}".format(ord(c)) for c in result)) == "07"
+        # while a test is running the device answers the beep command with BEL
+        return self.read_frame(deadline, token).frame_type == protocol.FrameType.BEL
 
-    def start_test(self):
-        self.send_custom_command(ActualTestingDevice.START_TEST_COMMAND)
+    def start_test(self, deadline=None, token=None):
+        deadline, token = self.begin_operation(deadline, token)
+        self.send_custom_command(ActualTestingDevice.START_TEST_COMMAND, deadline, token)
+        self.check_deadline(deadline, token)
         self.ser.reset_input_buffer()
 
-    def clear_all_reports(self):
-        self.get_all_reports()
+    def clear_all_reports(self, deadline=None, token=None):
+        self.get_all_report_strings(deadline, token)
 
     def close_communication(self):
         self.ser.close()
 
 
+class DeviceWatchdog(threading.Thread):
+    """ Periodically asks the device to abort any serial I/O that has been blocked for too long """
+
+    CHECK_INTERVAL = 0.5
+
+    def __init__(self, device: TestingDevice):
+        super().__init__(daemon=True)
+        self.device = device
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        while not self._stopped.wait(self.CHECK_INTERVAL):
+            try:
+                self.device.check_for_stall()
+            except Exception:
+                logging.exception('Unexpected exception in device watchdog.')
+
+
 class TextFeedback(QtCore.QObject):
 
     text_feedback_update = QtCore.pyqtSignal(str)
@@ -443,26 +758,46 @@ class TestManager(QtCore.QThread):
     show_filename_dialog = QtCore.pyqtSignal(int)
     unexpected_shutdown_detected = QtCore.pyqtSignal(int)
     communication_error = QtCore.pyqtSignal(int)
+    report_downloaded = QtCore.pyqtSignal(str)
 
     POLLING_INTERVAL = 5
+    BATCH_COUNTER_FILE_NAME = 'batch_counter'
+    RECOVERY_ATTEMPTS = 3
+    RECOVERY_INTERVAL = 1
+    MAX_RECOVERIES_PER_CYCLE = 3
     TEMP_FOLDER = 'temp'
+    ARCHIVE_INDEX_FILE_NAME = 'archive-index'
+    BACKUP_HASH_LENGTH = 12
 
     def on_reconnect_signal(self, number: int):
         self.device.reconnect()
 
     def on_startup(self, number: int):
-        self.status_feedback.set_text("Connected to {0}".format(self.device.identify()))
+        # runs on the GUI thread, an exception escaping a slot would abort the application
+        try:
+            self.status_feedback.set_text("Connected to {0}".format(self.device.identify()))
+        except (serial.SerialException, protocol.FrameError):
+            logging.exception('Could not identify the device.')
+            self.communication_error.emit(1)
         if os.path.exists(self.TEMP_FOLDER + '/test_running'):
             logging.warning('Unexpected shutdown detected.')
             self.unexpected_shutdown_detected.emit(1)
 
+    def on_shutdown(self):
+        self.watchdog.stop()
+        self.tracer.flush()
+        for store in (self.backup_store, self.reports_store):
+            if store is not None:
+                store.flush()
+
     def on_filename_available(self, filename: str):
         if filename:
-            self.last_report.store_as_xlsx(filename)
+            with self.tracer.phase('user save'):
+                self.last_report.store_as_xlsx(filename)
             self.text_feedback.append_new_line("Report was saved to {0}".format(filename))
         else:
-            self.text_feedback.append_new_line("Report was NOT saved. Please note that a backup copy was stored"
-                                               " in {0}/backups".format(os.getcwd()))
+            self.text_feedback.append_new_line("Report was NOT saved. Please note that {0}"
+                                               .format(self.describe_backup()))
         self.end_test()
 
     def resume(self):
@@ -470,7 +805,9 @@ class TestManager(QtCore.QThread):
         self.start_test_control.disable()
         self.loading_indicator.enable()
         self.text_feedback.append_new_line("Unexpected shutdown detected. Waiting for report...")
-        self.wait_for_report()
+        if self.batch_mode and self.batch_started_at is None:
+            self.batch_started_at = time.monotonic()
+        return self.wait_for_report()
 
     def on_should_resume(self, should_resume: bool):
         if should_resume:
@@ -492,8 +829,15 @@ class TestManager(QtCore.QThread):
             os.makedirs(self.backup_folder)
 
         self.backup_folder_max_size = config.backup_folder_max_size
+        self.archive_flushed_reports = config.archive_flushed_reports
+        self.archive_index_path = self.backup_folder + '/' + self.ARCHIVE_INDEX_FILE_NAME
+        self.archived_hashes = self.load_archive_index()
+        # reports appended to a consolidated backup workbook that was not written yet
+        self.pending_hashes = set()
 
         self.please_resume = False
+        # updated by the test thread as it goes, so a supervisor can tell a wedged thread from a long test
+        self.last_progress = time.monotonic()
 
         self.device = device
         self.text_feedback: TextFeedback = TextFeedback()
@@ -502,15 +846,175 @@ class TestManager(QtCore.QThread):
         self.loading_indicator: LoadingIndicator = LoadingIndicator()
         self.last_report = None
 
+        self.default_reports_folder = config.default_reports_folder
+        self.batch_mode = config.batch_mode
+        self.batch_trigger = config.batch_trigger
+        self.batch_pause = config.batch_pause
+        self.filename_template = config.filename_template
+        self.batch_counter = self.load_batch_counter()
+        self.batch_stop_requested = False
+        self.batch_started_at = None
+        self.batch_cycles = 0
+
+        self.backup_store = None
+        self.reports_store = None
+        if config.consolidate in RollingWorkbookStore.MODES:
+            self.backup_store = RollingWorkbookStore(self.backup_folder, config.consolidate,
+                                                     config.consolidate_flush_every, 'backup')
+            self.reports_store = RollingWorkbookStore(self.default_reports_folder, config.consolidate,
+                                                      config.consolidate_flush_every, 'reports')
+
+        self.tracer = PhaseTracer()
+        self.profiler = None
+        if config.profile:
+            session = int(time.time() * 1000)
+            self.tracer = PhaseTracer('{0}/trace-{1}.json'.format(config.logs_folder, session))
+            # the profiler accumulates over every test run on the worker thread
+            self.profiler = cProfile.Profile()
+            self.profile_path = '{0}/worker-{1}.prof'.format(config.logs_folder, session)
+
+        self.watchdog = DeviceWatchdog(device)
+        self.watchdog.start()
+
+    def load_archive_index(self):
+        if not os.path.exists(self.archive_index_path):
+            return set()
+        with open(self.archive_index_path) as f:
+            return set(line.strip() for line in f if line.strip())
+
+    @staticmethod
+    def hash_report_string(report_string: str):
+        return hashlib.sha1(report_string.encode(errors='ignore')).hexdigest()
+
+    def add_to_archive_index(self, report_hash: str):
+        self.pending_hashes.discard(report_hash)
+        self.archived_hashes.add(report_hash)
+        with open(self.archive_index_path, 'a') as f:
+            f.write(report_hash + '\n')
+
+    # backups are named after the test rather than the time they were stored, so reports archived back to back
+    # cannot overwrite each other and old reports do not look like the newest ones
+    def backup_path(self, report: TestReport):
+        return "{0}/{1}-{2}.xlsx".format(self.backup_folder, int(report.date.timestamp() * 1000),
+                                         self.hash_report_string(report.raw)[:self.BACKUP_HASH_LENGTH])
+
+    def store_backup(self, report: TestReport):
+        report_hash = self.hash_report_string(report.raw)
+        if self.backup_store is not None:
+            # only indexed once the workbook is written, a crash before that must not hide the report
+            self.pending_hashes.add(report_hash)
+            self.backup_store.append(report, lambda: self.add_to_archive_index(report_hash))
+        else:
+            report.store_as_xlsx(self.backup_path(report))
+            self.add_to_archive_index(report_hash)
+
+    def describe_backup(self):
+        if self.backup_store is not None and self.backup_store.pending > 0:
+            return "a backup copy will be written to {0} within {1} reports or when the application is closed" \
+                .format(self.backup_store.last_path, self.backup_store.flush_every - self.backup_store.pending)
+        return "a backup copy was stored in {0}".format(self.backup_folder)
+
+    # stores a report found in the device's cache in the backup folder, unless an identical one is already there
+    def archive_report_string(self, report_string: str):
+        report_hash = self.hash_report_string(report_string)
+        if report_hash in self.archived_hashes or report_hash in self.pending_hashes:
+            logging.debug('Flushed report already archived, skipping.')
+            return False
+        try:
+            report = TestReport(report_string)
+        except (IndexError, ValueError):
+            logging.exception('Could not parse flushed report, discarding it.')
+            return False
+        self.store_backup(report)
+        return True
+
+    # empties the device's cache, otherwise we'll get an old report
+    # returns False if the device answered with a malformed frame, leaving the cache in an unknown state
+    def flush_reports(self):
+        archived = 0
+        try:
+            if not self.archive_flushed_reports:
+                self.device.clear_all_reports()
+                return True
+            # archived one by one, so the reports read before a malformed frame are not lost
+            while True:
+                self.last_progress = time.monotonic()
+                if self.archive_report_string(self.device.get_first_available_report_string()):
+                    archived += 1
+        except NoReportException:
+            return True
+        except protocol.FrameError:
+            logging.exception('Could not empty the device\'s cache.')
+            return False
+        finally:
+            if archived > 0:
+                logging.info('{0} flushed reports archived in {1}.'.format(archived, self.backup_folder))
+
+    def load_batch_counter(self):
+        try:
+            with open(self.TEMP_FOLDER + '/' + self.BATCH_COUNTER_FILE_NAME) as f:
+                return int(f.read().strip() or 0)
+        except (IOError, ValueError):
+            return 0
+
+    def save_batch_counter(self):
+        with open(self.TEMP_FOLDER + '/' + self.BATCH_COUNTER_FILE_NAME, 'w') as f:
+            f.write(str(self.batch_counter))
+
+    def format_report_filename(self, report: TestReport, counter: int):
+        filename = self.filename_template.format(name=report.name.strip(), date=report.date,
+                                                 counter=counter, verdict=report.verdict)
+        return os.path.join(self.default_reports_folder, filename.replace(os.sep, '-'))
+
+    # batch mode replacement for the filename dialog
+    def store_batch_report(self, report: TestReport):
+        try:
+            if self.reports_store is not None:
+                filename = self.reports_store.append(report)
+                self.text_feedback.append_new_line("Report was appended to {0}".format(filename))
+            else:
+                filename = self.format_report_filename(report, self.batch_counter + 1)
+                report.store_as_xlsx(filename)
+                self.text_feedback.append_new_line("Report was saved to {0}".format(filename))
+            # a report that could not be saved does not use up a number
+            self.batch_counter += 1
+            self.save_batch_counter()
+        except (IOError, KeyError, IndexError, ValueError, AttributeError):
+            # a full disk or a broken filename_template would fail every following cycle as well
+            logging.exception('Could not save batch report.')
+            self.text_feedback.append_new_line("Report was NOT saved, stopping the batch. Please note that {0}"
+                                               .format(self.describe_backup()))
+            self.batch_stop_requested = True
+            self.end_test()
+            return
+
+        self.batch_cycles += 1
+        elapsed = time.monotonic() - self.batch_started_at
+        cycles_per_hour = self.batch_cycles * 3600 / elapsed if elapsed > 0 else 0
+        self.text_feedback.append_new_line("Cycle {0} completed ({1:.1f} cycles/hour).".format(self.batch_cycles,
+                                                                                              cycles_per_hour))
+        logging.info('Batch cycle {0} completed, {1:.1f} cycles/hour.'.format(self.batch_cycles, cycles_per_hour))
+        self.end_test()
+
+    def stop_batch(self):
+        self.batch_stop_requested = True
+        self.text_feedback.append_new_line("Batch will stop after the current test.")
+
     def clean_backup_folder(self):
-        size = sum(os.path.getsize(self.backup_folder + '/' + f) for f in os.listdir(self.backup_folder) if os.path.isfile(self.backup_folder + '/' + f))
+        files = [f for f in os.listdir(self.backup_folder)
+                 if os.path.isfile(self.backup_folder + '/' + f) and f != self.ARCHIVE_INDEX_FILE_NAME]
+        size = sum(os.path.getsize(self.backup_folder + '/' + f) for f in files)
         logging.debug('Backup folder size is {0}'.format(size))
         if size > self.backup_folder_max_size:
             logging.info('Backup folder max size exceeded. Purging backups starting from the oldest.')
-            files = os.listdir(self.backup_folder)
-            files.sort()
+            # consolidated workbooks are named after their day or preset, only their modification time tells their age
+            files.sort(key=lambda f: os.path.getmtime(self.backup_folder + '/' + f))
+            if self.backup_store is not None:
+                # the workbooks still being filled would be written again on the next flush anyway
+                open_files = set(os.path.basename(path) for path in self.backup_store.open_paths())
+                files = [f for f in files if f not in open_files]
             i = 0
-            while size > self.backup_folder_max_size:
+            while size > self.backup_folder_max_size and i < len(files):
                 file_size = os.path.getsize(self.backup_folder + '/' + files[i])
                 os.remove(self.backup_folder + '/' + files[i])
                 size -= file_size
@@ -518,44 +1022,151 @@ class TestManager(QtCore.QThread):
             logging.info('{0} files deleted.'.format(i))
 
     def end_test(self):
-        self.start_test_control.enable()
-        self.loading_indicator.disable()
-        os.remove(self.TEMP_FOLDER + '/test_running')
-        self.please_resume = False
+        with self.tracer.phase('end_test'):
+            self.start_test_control.enable()
+            self.loading_indicator.disable()
+            os.remove(self.TEMP_FOLDER + '/test_running')
+            self.please_resume = False
+        self.tracer.flush()
+
+    # reconnects to the device after its I/O stalled, without requiring an operator
+    def recover(self):
+        for attempt in range(1, self.RECOVERY_ATTEMPTS + 1):
+            self.last_progress = time.monotonic()
+            logging.warning('Device I/O stalled or timed out, reconnecting (attempt {0}/{1}).'
+                            .format(attempt, self.RECOVERY_ATTEMPTS))
+            try:
+                if self.device.reconnect():
+                    logging.info('Recovered from device stall. Stalls so far: {0}, durations: {1}'
+                                 .format(self.device.stall_count, self.device.stall_durations))
+                    return True
+            except (serial.SerialException, OSError):
+                logging.exception('Exception while reconnecting to the device.')
+            time.sleep(self.RECOVERY_INTERVAL)
+        return False
+
+    # a device that keeps stalling after reconnecting would otherwise be recovered forever
+    def recover_from_stall(self, recoveries: int):
+        if recoveries > self.MAX_RECOVERIES_PER_CYCLE:
+            logging.error('Device stalled {0} times during this test, giving up.'.format(recoveries))
+        elif self.recover():
+            return True
+        self.communication_error.emit(1)
+        return False
+
+    def download_report(self):
+        while True:
+            self.last_progress = time.monotonic()
+            with self.tracer.phase('is_testing'):
+                testing = self.device.is_testing()
+            if not testing:
+                break
+            time.sleep(self.POLLING_INTERVAL)
+
+        with self.tracer.phase('report download'):
+            report_string = self.device.get_first_available_report_string()
+        with self.tracer.phase('parse'):
+            report = TestReport(report_string)
+        self.report_downloaded.emit(report_string)
+        self.text_feedback.append_new_line("Report downloaded succesfully.")
+        self.last_report = report
+        with self.tracer.phase('backup xlsx'):
+            self.store_backup(report)
+        if self.batch_mode:
+            self.store_batch_report(report)
+        else:
+            self.show_filename_dialog.emit(1)
 
     def wait_for_report(self):
         self.clean_backup_folder()
-        try:
-            while self.device.is_testing():
-                time.sleep(self.POLLING_INTERVAL)
-
-            report = self.device.get_first_available_report()
-            self.text_feedback.append_new_line("Report downloaded succesfully.")
-            self.last_report = report
-            report.store_as_xlsx("{0}/{1}.xlsx".format(self.backup_folder, (int(time.time() * 1000))))
-            self.show_filename_dialog.emit(1)
-        except serial.SerialException or OSError:
-            self.communication_error.emit(1)
-        except NoReportException:
-            self.text_feedback.append_new_line('Test stopped. Ready for new test.')
-            self.end_test()
+        recoveries = 0
+        while True:
+            try:
+                self.download_report()
+            except (serial.SerialTimeoutException, OperationCancelledException):
+                recoveries += 1
+                if self.recover_from_stall(recoveries):
+                    continue
+                return False
+            except protocol.FrameError:
+                # reconnecting discards whatever is left of the malformed answer
+                logging.exception('Malformed answer while waiting for the report.')
+                recoveries += 1
+                if self.recover_from_stall(recoveries):
+                    continue
+                self.text_feedback.append_new_line('The report could not be read. Ready for new test.')
+                self.end_test()
+                return False
+            except serial.SerialException or OSError:
+                self.communication_error.emit(1)
+                return False
+            except NoReportException:
+                self.text_feedback.append_new_line('Test stopped. Ready for new test.')
+                self.end_test()
+                # the operator aborted the test on the device, a continuous batch must not start the next one
+                return False
+            return True
 
     def start_test(self):
-        self.device.get_all_reports()
-        try:
-            self.device.start_test()
-            self.start_test_control.disable()
-            self.loading_indicator.enable()
-            Path(self.TEMP_FOLDER + '/test_running').touch()
-            self.text_feedback.clear()
-            self.text_feedback.append_new_line("Test started.")
-            self.text_feedback.append_new_line("Waiting for report...")
-            self.wait_for_report()
-        except serial.SerialException:
-            self.communication_error.emit(1)
+        if self.batch_mode and self.batch_started_at is None:
+            self.batch_started_at = time.monotonic()
+        self.tracer.begin_cycle()
+        self.last_progress = time.monotonic()
+        recoveries = 0
+        while True:
+            try:
+                with self.tracer.phase('start_test drain'):
+                    drained = self.flush_reports()
+                if drained:
+                    with self.tracer.phase('START_TEST command'):
+                        self.device.start_test()
+                    break
+                recoveries += 1
+                if not self.recover_from_stall(recoveries):
+                    return False
+            except (serial.SerialTimeoutException, OperationCancelledException):
+                recoveries += 1
+                if not self.recover_from_stall(recoveries):
+                    return False
+            except serial.SerialException:
+                self.communication_error.emit(1)
+                return False
+        self.start_test_control.disable()
+        self.loading_indicator.enable()
+        Path(self.TEMP_FOLDER + '/test_running').touch()
+        self.text_feedback.clear()
+        self.text_feedback.append_new_line("Test started.")
+        self.text_feedback.append_new_line("Waiting for report...")
+        return self.wait_for_report()
+
+    # starts tests back to back until stopped or a communication error occurs
+    def run_batch(self):
+        self.batch_stop_requested = False
+        self.batch_started_at = time.monotonic()
+        self.batch_cycles = 0
+        while not self.batch_stop_requested:
+            if not self.start_test():
+                break
+            time.sleep(self.batch_pause)
+        self.text_feedback.append_new_line("Batch stopped.")
 
     def run(self):
+        if self.profiler is None:
+            self.run_tests()
+            return
+        self.profiler.enable()
+        try:
+            self.run_tests()
+        finally:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.profile_path)
+
+    def run_tests(self):
+        continuous = self.batch_mode and self.batch_trigger == 'continuous'
         if self.please_resume:
-            self.resume()
+            if self.resume() and continuous:
+                self.run_batch()
+        elif continuous:
+            self.run_batch()
         else:
             self.start_test()
@@ -0,0 +1,80 @@
+# coding=UTF-8
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class PhaseTracer:
+    """ Records the phases of each test cycle as a Chrome trace (viewable in chrome://tracing or Perfetto)
+
+    Events are appended to the file on every flush, as an unterminated JSON array which the trace viewers accept,
+    so neither the file writes nor the memory grow with the number of cycles.
+    When no path is given the tracer is disabled and all of its methods do nothing.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.enabled = path is not None
+        self.cycle = 0
+        # recorded since the last flush
+        self.events = []
+        self.started = False
+        self.named_threads = set()
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+
+    def now(self):
+        return (time.perf_counter() - self.origin) * 1000000
+
+    def add_event(self, event: dict):
+        event['pid'] = os.getpid()
+        event['tid'] = threading.get_ident()
+        event.setdefault('args', {}).setdefault('cycle', self.cycle)
+        with self.lock:
+            if event['tid'] not in self.named_threads:
+                self.named_threads.add(event['tid'])
+                self.events.append({'name': 'thread_name', 'ph': 'M', 'pid': event['pid'], 'tid': event['tid'],
+                                    'args': {'name': threading.current_thread().name}})
+            self.events.append(event)
+
+    def begin_cycle(self):
+        self.cycle += 1
+
+    @contextmanager
+    def phase(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.add_event({'name': name, 'ph': 'X', 'ts': start, 'dur': self.now() - start})
+
+    # cycle defaults to the current one, events preceding begin_cycle can name the cycle they lead to
+    def instant(self, name: str, cycle: int = None):
+        if self.enabled:
+            event = {'name': name, 'ph': 'i', 's': 't', 'ts': self.now()}
+            if cycle is not None:
+                event['args'] = {'cycle': cycle}
+            self.add_event(event)
+
+    def flush(self):
+        if not self.enabled:
+            return
+        with self.lock:
+            events, self.events = self.events, []
+            if not events:
+                return
+            try:
+                with open(self.path, 'a' if self.started else 'w') as f:
+                    if not self.started:
+                        f.write('[\n')
+                    for event in events:
+                        f.write(json.dumps(event) + ',\n')
+                self.started = True
+            except IOError:
+                logging.exception('Could not write trace to {0}'.format(self.path))
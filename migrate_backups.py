@@ -0,0 +1,187 @@
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+from configparser import ConfigParser
+
+from openpyxl import load_workbook
+
+from custom_libs.schleichore import RollingWorkbookStore, TestReport
+
+CHECKPOINT_FILE_NAME = 'migration-checkpoint'
+JSON_LINES_FILE_NAME = 'reports.jsonl'
+FORMATS = ('jsonl',) + RollingWorkbookStore.MODES
+# backups are named after a time in milliseconds, newer ones followed by a prefix of the report's hash
+BACKUP_NAME = re.compile(r'^\d+(-[0-9a-f]+)?\.xlsx$')
+
+
+def default_backup_folder():
+    parser = ConfigParser()
+    parser.read('configuration.ini')
+    return parser.get('reports', 'backup_folder', fallback='./backups')
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Converts the backups stored by store_as_xlsx to another format. '
+                                                 'An interrupted run picks up where it stopped.')
+    parser.add_argument('output', help='Folder where converted reports and the checkpoint are written.')
+    parser.add_argument('--format', choices=FORMATS, default='jsonl',
+                        help='jsonl: one JSON report per line. daily, preset: rolling workbooks like '
+                             '[reports] consolidate.')
+    parser.add_argument('--backup-folder', default=None,
+                        help='Defaults to backup_folder from configuration.ini.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of reader processes.')
+    parser.add_argument('--checkpoint-every', type=int, default=200,
+                        help='Number of converted backups written between checkpoints.')
+    return parser.parse_args()
+
+
+def load_checkpoint(path: str):
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return set(line.strip() for line in f if line.strip())
+
+
+# runs in the pool's worker processes
+def read_backup(path: str):
+    try:
+        return os.path.basename(path), TestReport.from_xlsx(path), None
+    except Exception as e:
+        return os.path.basename(path), None, '{0}: {1}'.format(type(e).__name__, e)
+
+
+class BackupMigration:
+    """ Writes converted reports and records their backups in the checkpoint
+
+    A run interrupted after writing reports but before recording them must not convert them twice when resumed, so
+    the reports already in the output are looked up again: JSON lines carry the name of their backup, workbook
+    summaries the preset name and date of their reports.
+    """
+
+    def __init__(self, output: str, report_format: str):
+        self.output = output
+        self.report_format = report_format
+        self.checkpoint_path = os.path.join(output, CHECKPOINT_FILE_NAME)
+        self.json_lines_path = os.path.join(output, JSON_LINES_FILE_NAME)
+        self.store = None
+        if report_format in RollingWorkbookStore.MODES:
+            # flushed explicitly at every checkpoint, every workbook stays in memory until the end of the run
+            self.store = RollingWorkbookStore(output, report_format, sys.maxsize, 'backup', sys.maxsize)
+        # (preset name, date) of the reports already in the output workbooks
+        self.written_reports = set()
+        self.pending_reports = []
+        self.pending_names = []
+
+    # returns the names of the backups that were already converted
+    def resume(self):
+        converted = load_checkpoint(self.checkpoint_path)
+        if self.store is None:
+            converted |= self.read_json_lines()
+        else:
+            self.written_reports = self.read_workbook_summaries()
+        return converted
+
+    def read_json_lines(self):
+        if not os.path.exists(self.json_lines_path):
+            return set()
+        names = set()
+        with open(self.json_lines_path, 'rb+') as f:
+            complete = 0
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                complete += len(line)
+                names.add(json.loads(line)['backup'])
+            # a line cut short by the interruption is written again
+            f.truncate(complete)
+        return names
+
+    def read_workbook_summaries(self):
+        reports = set()
+        prefix = self.store.prefix + '-'
+        for name in os.listdir(self.output):
+            if not (name.startswith(prefix) and name.endswith('.xlsx')):
+                continue
+            wb = load_workbook(os.path.join(self.output, name), read_only=True)
+            try:
+                rows = wb[RollingWorkbookStore.SUMMARY_SHEET_TITLE].iter_rows(min_row=2, values_only=True)
+                reports.update((row[0], row[1]) for row in rows)
+            finally:
+                wb.close()
+        return reports
+
+    def add(self, name: str, report: TestReport):
+        if (report.name, report.date) in self.written_reports:
+            # written before the previous run was interrupted, only the checkpoint is missing
+            self.pending_names.append(name)
+            return
+        self.pending_reports.append((name, report))
+        self.pending_names.append(name)
+
+    def checkpoint(self):
+        if self.store is not None:
+            for _, report in self.pending_reports:
+                self.store.append(report)
+            self.store.flush()
+        else:
+            with open(self.json_lines_path, 'a') as f:
+                for name, report in self.pending_reports:
+                    f.write(json.dumps(dict(report.as_dict(), backup=name)) + '\n')
+        # only recorded once the converted reports are on disk
+        with open(self.checkpoint_path, 'a') as f:
+            for name in self.pending_names:
+                f.write(name + '\n')
+        self.pending_reports = []
+        self.pending_names = []
+
+
+def print_progress(done: int, total: int, started_at: float):
+    elapsed = time.monotonic() - started_at
+    throughput = done / elapsed if elapsed > 0 else 0
+    remaining = (total - done) / throughput if throughput > 0 else 0
+    print('\r{0}/{1} backups, {2:.1f} files/s, {3:.0f} s remaining'.format(done, total, throughput, remaining),
+          end='', flush=True)
+
+
+def migrate():
+    arguments = parse_arguments()
+    backup_folder = arguments.backup_folder or default_backup_folder()
+    os.makedirs(arguments.output, exist_ok=True)
+
+    migration = BackupMigration(arguments.output, arguments.format)
+    converted = migration.resume()
+    # oldest first, so rolling workbooks are filled in chronological order
+    names = sorted(f for f in os.listdir(backup_folder) if BACKUP_NAME.match(f) and f not in converted)
+    if converted:
+        print('Resuming: {0} backups already converted.'.format(len(converted)))
+    if not names:
+        print('Nothing to convert.')
+        return
+
+    failures = []
+    started_at = time.monotonic()
+    with multiprocessing.Pool(max(1, arguments.workers)) as pool:
+        paths = [os.path.join(backup_folder, name) for name in names]
+        # imap keeps the input order, which the rolling workbooks rely on
+        for done, (name, report, error) in enumerate(pool.imap(read_backup, paths, chunksize=16), start=1):
+            if report is None:
+                failures.append((name, error))
+            else:
+                migration.add(name, report)
+            if len(migration.pending_names) >= arguments.checkpoint_every:
+                migration.checkpoint()
+            print_progress(done, len(names), started_at)
+    migration.checkpoint()
+    print()
+
+    for name, error in failures:
+        print('Could not convert {0}: {1}'.format(name, error), file=sys.stderr)
+    print('{0} backups converted, {1} failed.'.format(len(names) - len(failures), len(failures)))
+
+
+if __name__ == "__main__":
+    migrate()
@@ -1,3 +1,4 @@
+import datetime
 import logging
 import os
 import sys
@@ -5,6 +6,8 @@ import sys
 from serial import SerialException
 from configparser import ConfigParser
 
+from custom_libs.control_api import ControlApi
+from custom_libs.device_process import ProcessTestManager
 from custom_libs.gui import UiMainWindow, QtWidgets
 from custom_libs.schleichore import ActualTestingDevice, FakeTestingDevice, TestManager
 
@@ -22,6 +25,9 @@ class Configuration:
         4: logging.ERROR,
         5: logging.CRITICAL
     }
+    BATCH_TRIGGERS = ('manual', 'continuous')
+    CONSOLIDATE_MODES = ('none', 'daily', 'preset')
+    DEFAULT_FILENAME_TEMPLATE = '{name}_{date:%Y%m%d-%H%M%S}_{counter:06d}_{verdict}'
 
     def __init__(self):
         parser = ConfigParser()
@@ -58,24 +64,52 @@ class Configuration:
             self.default_reports_folder = parser.get('reports', 'default_folder', fallback='./')
             self.backup_folder = parser.get('reports', 'backup_folder', fallback='./backups')
             self.backup_folder_max_size = int(parser.get('reports', 'backup_folder_max_size', fallback='512')) * 1024 * 1024
+            self.archive_flushed_reports = parser.getboolean('reports', 'archive_flushed_reports', fallback=True)
+            self.consolidate = parser.get('reports', 'consolidate', fallback='none')
+            if self.consolidate not in self.CONSOLIDATE_MODES:
+                raise ValueError('Unknown consolidation mode {0}'.format(self.consolidate))
+            self.consolidate_flush_every = int(parser.get('reports', 'consolidate_flush_every', fallback='20'))
+
+            self.operation_timeout = float(parser.get('device', 'operation_timeout', fallback='5'))
+            self.stall_threshold = float(parser.get('device', 'stall_threshold', fallback='3'))
+            self.separate_process = parser.getboolean('device', 'separate_process', fallback=False)
+
+            self.batch_mode = parser.getboolean('batch', 'enabled', fallback=False)
+            self.batch_trigger = parser.get('batch', 'trigger', fallback='manual')
+            if self.batch_trigger not in self.BATCH_TRIGGERS:
+                raise ValueError('Unknown batch trigger {0}'.format(self.batch_trigger))
+            self.batch_trigger_key = parser.get('batch', 'trigger_key', fallback='Space')
+            self.batch_pause = float(parser.get('batch', 'pause', fallback='2'))
+            # raw, since the template contains strftime directives
+            self.filename_template = parser.get('batch', 'filename_template', raw=True,
+                                                fallback=self.DEFAULT_FILENAME_TEMPLATE)
+            # fail early on unknown fields or malformed format specs
+            self.filename_template.format(name='', date=datetime.datetime.now(), counter=0, verdict='')
+
+            self.api_enabled = parser.getboolean('api', 'enabled', fallback=False)
+            self.api_host = parser.get('api', 'host', fallback='127.0.0.1')
+            self.api_port = int(parser.get('api', 'port', fallback='8080'))
+            self.api_history = int(parser.get('api', 'history', fallback='100'))
 
             self.fake = parser.getboolean('debug', 'fake', fallback=False)
+            self.profile = parser.getboolean('debug', 'profile', fallback=False)
+            self.logs_folder = self.LOGS_FOLDER
 
-        except ValueError:
+        except (ValueError, KeyError, IndexError, AttributeError):
             print('Unexpected value in configuration file. Quitting.')
             exit(1)
 
 
 # searches for the device on the first 100 USB-RS232 adapters
 # returns a list of tuples like ('/dev/ttyUSB1', id_string)
-def get_devices():
+def get_devices(config):
     base_serial_string = "/dev/ttyUSB"
     devices = []
     i = -1
     while i < 100:
         try:
             i += 1
-            device = ActualTestingDevice(base_serial_string + str(i))
+            device = ActualTestingDevice(base_serial_string + str(i), config.operation_timeout, config.stall_threshold)
             id_string = device.identify()
             # this may need to be improved by actually checking the response
             if len(id_string) > 0:
@@ -103,26 +137,34 @@ def init_app():
 
     app = QtWidgets.QApplication(sys.argv)
     screen_geometry = app.desktop().screenGeometry()
-    available_devices = get_devices()
+    available_devices = get_devices(config)
     if len(available_devices) == 0 and not config.fake:
         error_dialog = QtWidgets.QErrorMessage()
         error_dialog.showMessage('No connected device available. Exiting.')
         sys.exit(app.exec_())
     else:
         main_window = QtWidgets.QMainWindow()
-        device = None
-        if not config.fake:
-            device = ActualTestingDevice(available_devices[0][0])
-
-            # we need to flush the device's cache, otherwise we'll get an old report
-            # maybe we could ask the user if he wants to store these
-            device.get_all_reports()
+        if config.separate_process:
+            # the device process opens the port and flushes the device's cache by itself
+            test_manager = ProcessTestManager(None if config.fake else available_devices[0][0], config)
         else:
-            device = FakeTestingDevice("/dev/DEBUG")
+            device = None
+            if not config.fake:
+                device = ActualTestingDevice(available_devices[0][0], config.operation_timeout, config.stall_threshold)
+            else:
+                device = FakeTestingDevice("/dev/DEBUG")
 
-        test_manager = TestManager(device, config)
+            test_manager = TestManager(device, config)
+            # we need to flush the device's cache, otherwise we'll get an old report
+            test_manager.flush_reports()
         ui = UiMainWindow(test_manager, config)
         ui.setup_ui(main_window, screen_geometry)
+        app.aboutToQuit.connect(test_manager.on_shutdown)
+        if config.api_enabled:
+            control_api = ControlApi(test_manager, config)
+            control_api.start_test_requested.connect(ui.on_trigger_key)
+            app.aboutToQuit.connect(control_api.stop)
+            control_api.start()
         main_window.showMaximized()
         # this code should not be here, but I couldn't find a better way to do this
         ui.startup.emit(1)
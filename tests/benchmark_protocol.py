@@ -0,0 +1,46 @@
+# coding=UTF-8
+""" Compares protocol.decode with the string checks it replaced
+
+Run with: python -m tests.benchmark_protocol
+"""
+import timeit
+
+from custom_libs import protocol
+from tests.test_protocol import FRAMES
+
+NUMBER = 100000
+
+
+# what ActualTestingDevice did before the codec: decode everything, then look at the text
+def old_is_testing(data: bytes):
+    result = data.decode(errors='ignore')
+    return (":".join("{:02x}".format(ord(c)) for c in result)) == "07"
+
+
+def old_is_empty(data: bytes):
+    result = data.decode(errors='ignore')
+    return len(result.strip().replace('\x07', '').replace('\x15', '').replace('4', '').replace('\x03', '')
+               .replace('2', '')) == 0
+
+
+def new_is_testing(data: bytes):
+    return protocol.decode(data).frame_type == protocol.FrameType.BEL
+
+
+def new_is_empty(data: bytes):
+    return protocol.decode(data).frame_type == protocol.FrameType.EMPTY
+
+
+def main():
+    checks = [('is_testing', old_is_testing, new_is_testing), ('is_empty', old_is_empty, new_is_empty)]
+    for name in ('bel', 'empty', 'report'):
+        data = FRAMES[name][0]
+        for check, old, new in checks:
+            old_time = timeit.timeit(lambda: old(data), number=NUMBER)
+            new_time = timeit.timeit(lambda: new(data), number=NUMBER)
+            print('{0:>7} {1:<11} old {2:6.2f} us  new {3:6.2f} us  ({4:.1f}x)'.format(
+                name, check, old_time / NUMBER * 1e6, new_time / NUMBER * 1e6, old_time / new_time))
+
+
+if __name__ == '__main__':
+    main()
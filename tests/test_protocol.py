@@ -0,0 +1,142 @@
+# coding=UTF-8
+import os
+import random
+import unittest
+from unittest import mock
+
+from custom_libs import protocol
+from custom_libs.protocol import FrameType
+
+REPORT_BODY = (b'\x81 1 HV 1000 0.5 1001 0.1 X_2_Step*A 2 HV 1000 0.5 1001 0.2 X_2_Step*B '
+               b'NUM_1 NAME_Preset*1 DA_01.02.24_10:00:00 ')
+
+FRAMES_FOLDER = os.path.join(os.path.dirname(__file__), 'frames')
+
+# built from the protocol constants and encode(), the answers captured from a device are in FRAMES_FOLDER
+FRAMES = {
+    'ack': (bytes([protocol.ACK]), FrameType.ACK),
+    'bel': (bytes([protocol.BEL]), FrameType.BEL),
+    'bel with stray byte': (b'\x07\x81', FrameType.BEL),
+    'nak': (bytes([protocol.NAK]), FrameType.NAK),
+    'empty': (b'\x15\x0324', FrameType.EMPTY),
+    'empty with stray bytes': (b' \x81\n', FrameType.EMPTY),
+    'nothing': (b'', FrameType.EMPTY),
+    'report': (protocol.encode(REPORT_BODY), FrameType.REPORT),
+    'identification': (protocol.encode(b'\x81\xfdGLP2-e Conness.'), FrameType.IDENTIFICATION),
+}
+
+
+def load_captured_frames():
+    """ Reads the answers in FRAMES_FOLDER, named <frame type>-<description>.bin or .hex
+
+    .bin files hold the raw bytes, .hex files the colon separated hex ActualTestingDevice logs at level 1.
+    """
+    frames = {}
+    for name in sorted(os.listdir(FRAMES_FOLDER)):
+        stem, extension = os.path.splitext(name)
+        if extension not in ('.bin', '.hex'):
+            continue
+        with open(os.path.join(FRAMES_FOLDER, name), 'rb') as f:
+            data = f.read()
+        if extension == '.hex':
+            data = bytes.fromhex(data.decode().strip().replace(':', ''))
+        frames[stem] = (data, FrameType(stem.split('-')[0]))
+    return frames
+
+
+CAPTURED_FRAMES = load_captured_frames()
+
+
+class EncodeTest(unittest.TestCase):
+
+    def test_reproduces_command_checksums(self):
+        self.assertEqual(protocol.encode(b'\x81\xfab '), bytes([0x02, 0x81, 0xfa, 0x62, 0x20, 0x33, 0x42, 0x03]))
+        self.assertEqual(protocol.encode(b'\x81\xfas '), bytes([0x02, 0x81, 0xfa, 0x73, 0x20, 0x32, 0x41, 0x03]))
+
+
+class DecodeTest(unittest.TestCase):
+
+    def test_frame_types(self):
+        for name, (data, frame_type) in FRAMES.items():
+            with self.subTest(name):
+                self.assertEqual(protocol.decode(data).frame_type, frame_type)
+
+    def test_captured_frame_types(self):
+        if not CAPTURED_FRAMES:
+            self.skipTest('No captured answers in {0}'.format(FRAMES_FOLDER))
+        for name, (data, frame_type) in CAPTURED_FRAMES.items():
+            with self.subTest(name):
+                self.assertEqual(protocol.decode(data).frame_type, frame_type)
+
+    def test_identification_payload(self):
+        # the same string the device class extracted before the codec: 0x81 and 0xfd are dropped, then three
+        # characters are skipped
+        self.assertEqual(protocol.decode(FRAMES['identification'][0]).text(), 'P2-e ')
+
+    def test_report_payload(self):
+        self.assertIn('NAME_Preset*1', protocol.decode(FRAMES['report'][0]).text())
+
+    def test_unknown(self):
+        self.assertEqual(protocol.decode(b'hello').frame_type, FrameType.UNKNOWN)
+
+    def test_tolerated_around_reports(self):
+        report = FRAMES['report'][0]
+        tolerated = {
+            'leading ACK': bytes([protocol.ACK]) + report,
+            'trailing BEL': report + bytes([protocol.BEL]),
+            'stray bytes and line break': b' \x81' + report + b'\r\n',
+            'unframed': report[1:-3],
+        }
+        for name, data in tolerated.items():
+            with self.subTest(name):
+                self.assertEqual(protocol.decode(data).frame_type, FrameType.REPORT)
+
+    def test_malformed_reports(self):
+        report = FRAMES['report'][0]
+        malformed = {
+            'two frames': report + report,
+            'text before the frame': b'OK' + report,
+            'missing date': protocol.encode(REPORT_BODY.replace(b'DA_', b'XX_')),
+        }
+        for name, data in malformed.items():
+            with self.subTest(name):
+                with self.assertRaises(protocol.FrameError):
+                    protocol.decode(data)
+
+    def test_checksum_only_verified_when_enabled(self):
+        report = FRAMES['report'][0]
+        corrupted = report.replace(b'1001', b'1002', 1)
+        self.assertEqual(protocol.decode(corrupted).frame_type, FrameType.REPORT)
+        with mock.patch.object(protocol, 'VERIFY_CHECKSUM', True):
+            self.assertEqual(protocol.decode(b'\x06' + report).frame_type, FrameType.REPORT)
+            with self.assertRaises(protocol.FrameError):
+                protocol.decode(corrupted)
+
+    def test_only_raises_frame_error(self):
+        generator = random.Random(0)
+        samples = [data for data, _ in list(FRAMES.values()) + list(CAPTURED_FRAMES.values()) if data]
+        for _ in range(5000):
+            if generator.random() < 0.5:
+                data = bytes(generator.randrange(256) for _ in range(generator.randrange(64)))
+            else:
+                # flips, drops and inserts bytes of a real answer
+                data = bytearray(generator.choice(samples))
+                for _ in range(generator.randrange(1, 4)):
+                    position = generator.randrange(len(data) + 1)
+                    operation = generator.randrange(3)
+                    if operation == 0 and position < len(data):
+                        data[position] = generator.randrange(256)
+                    elif operation == 1 and position < len(data):
+                        del data[position]
+                    else:
+                        data.insert(position, generator.randrange(256))
+                data = bytes(data)
+            try:
+                frame = protocol.decode(data)
+            except protocol.FrameError:
+                continue
+            self.assertIsInstance(frame.frame_type, FrameType, data)
+
+
+if __name__ == '__main__':
+    unittest.main()